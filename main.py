@@ -1,17 +1,20 @@
+import functools
+import logging
+import re
 import sys
 
 from abc import ABC, abstractmethod
-from typing import Iterable, List, Tuple
-from xml.etree import ElementTree
-from xml.etree.ElementTree import Element
-
+from typing import Dict, Iterable, Optional, Tuple
+from lxml import etree
+from lxml.etree import XPath, _Element as Element
 from openpyxl import load_workbook
-from openpyxl.cell import Cell
 
 from ipaddress import IPv4Address, IPv4Network, ip_network
 
 __author__ = "Alejandro Cano Bermúdez"
 
+logger = logging.getLogger(__name__)
+
 #################
 ## Base classes
 #################
@@ -27,7 +30,7 @@ class RuleOption(ABC):
         Parameters
         ----------
         value : str
-            The column value
+            The column value, in lower case
 
         Returns
         -------
@@ -37,7 +40,7 @@ class RuleOption(ABC):
         ...
 
     @abstractmethod
-    def apply(self, xml: Element, value: str) -> None:
+    def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
         """Applies this option to the given XML document.
 
         Parameters
@@ -46,42 +49,27 @@ class RuleOption(ABC):
             The XML element
         value : str
             The option value
+        trackers : Dict[str, Element]
+            The firewall rules type nodes of the XML document by tracker ID
         """
         ...
 
 
 class Rule(ABC):
     """Rule.
-    """
-
-    @abstractmethod
-    def can_apply(self, title: str) -> bool:
-        """Checks if this rule should be applied in the given column.
 
-        Parameters
-        ----------
-        title : str
-            The column title
-
-        Returns
-        -------
-        bool
-            True if should be applied
-        """
-        ...
-
-    @abstractmethod
-    def get_options(self) -> Iterable[RuleOption]:
-        """Gets the rule options.
+    Attributes
+    ----------
+    trigger : str
+        Text (in lower case) the column title must contain for this rule to be applied
+    options : Tuple[RuleOption, ...]
+        The rule options
+    """
 
-        Returns
-        -------
-        Iterable[RuleOption]
-            The options
-        """
-        ...
+    trigger: str
+    options: Tuple[RuleOption, ...]
 
-    def apply(self, xml: Element, value: str) -> None:
+    def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
         """Applies this rule to the given XML document.
 
         Parameters
@@ -90,24 +78,56 @@ class Rule(ABC):
             The XML element
         value : str
             The column value
+        trackers : Dict[str, Element]
+            The firewall rules type nodes of the XML document by tracker ID
         """
-        for option in self.get_options():
-            if option.can_apply(value):
-                print(f'\t\tApplying {option.__class__.__name__}')
-                option.apply(xml, value)
+        value_lower = value.lower()
+
+        for option in self.options:
+            if option.can_apply(value_lower):
+                logger.debug('\t\tApplying %s', option.__class__.__name__)
+                option.apply(xml, value, trackers)
+
+
+######################
+## XPath expressions
+######################
+
+SQUIDGUARD_DEST_XPATH = XPath('installedpackages/squidguarddefault/config/dest')
+PFBLOCKERNG_SELECTED_XPATH = XPath('installedpackages/pfblockerngblacklist/item/selected')
+SQUID_ADMIN_EMAIL_XPATH = XPath('installedpackages/squid/config/admin_email')
+LAN_IPADDR_XPATH = XPath('interfaces/lan/ipaddr')
+
+# LAN network of the base configuration
+BASE_LAN_NETWORK = IPv4Network('192.168.100.1/24', strict=False)
 
 
 ####################
 ## Utility methods
 ####################
 
-def update_node_value(xml: Element, xpath: str, value: str) -> None:
-    node = xml.find(xpath)
+def build_tracker_index(xml: Element) -> Dict[str, Element]:
+    trackers: Dict[str, Element] = {}
+    for rule in xml.iterfind('filter/rule'):
+        tracker = rule.findtext('tracker')
+        if tracker is not None:
+            trackers.setdefault(tracker, rule.find('type'))
+
+    return trackers
+
+def update_node_value(xml: Element, xpath: XPath, value: str) -> None:
+    nodes = xpath(xml)
+    assert nodes
+    nodes[0].text = value
+
+def update_rule_type(trackers: Dict[str, Element], tracker: str, new_type: str) -> None:
+    node = trackers.get(tracker)
     assert node is not None
-    node.text = value
+    node.text = new_type
 
-def update_rule_type(xml: Element, tracker: str, new_type: str) -> None:
-    update_node_value(xml, f'filter/rule/tracker[.="{tracker}"]..type', new_type)
+@functools.lru_cache(maxsize=256)
+def parse_network(value: str) -> IPv4Network:
+    return IPv4Network(value, strict=False)
 
 
 ######################
@@ -116,132 +136,123 @@ def update_rule_type(xml: Element, tracker: str, new_type: str) -> None:
 
 class ProtocolsRule(Rule):
 
+    trigger = 'estos protocolos utiliza'
+
 
     class OptionFTP(RuleOption):
 
         def can_apply(self, value: str) -> bool:
-            return 'ftp' in value.lower()
+            return 'ftp' in value
 
-        def apply(self, xml: Element, value: str) -> None:
-            update_rule_type(xml, '1629481790', 'pass') # WAN
-            update_rule_type(xml, '1629485503', 'pass') # LAN
+        def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
+            update_rule_type(trackers, '1629481790', 'pass') # WAN
+            update_rule_type(trackers, '1629485503', 'pass') # LAN
 
 
     class OptionSMB(RuleOption):
 
         def can_apply(self, value: str) -> bool:
-            return 'smb' in value.lower()
+            return 'smb' in value
 
-        def apply(self, xml: Element, value: str) -> None:
-            update_rule_type(xml, '1629485258', 'pass') # WAN
-            update_rule_type(xml, '1629485518', 'pass') # LAN
+        def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
+            update_rule_type(trackers, '1629485258', 'pass') # WAN
+            update_rule_type(trackers, '1629485518', 'pass') # LAN
 
 
     class OptionSSH(RuleOption):
 
         def can_apply(self, value: str) -> bool:
-            return 'ssh' in value.lower()
-
-        def apply(self, xml: Element, value: str) -> None:
-            update_rule_type(xml, '1629479843', 'pass') # WAN
-            update_rule_type(xml, '1629479704', 'pass') # LAN
+            return 'ssh' in value
 
+        def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
+            update_rule_type(trackers, '1629479843', 'pass') # WAN
+            update_rule_type(trackers, '1629479704', 'pass') # LAN
 
-    def get_options(self) -> Iterable[RuleOption]:
-        return (
-            self.OptionFTP(),
-            self.OptionSMB(),
-            self.OptionSSH(),
-        )
 
-    def can_apply(self, title: str) -> bool:
-        return 'estos protocolos utiliza' in title.lower()
+    options = (
+        OptionFTP(),
+        OptionSMB(),
+        OptionSSH(),
+    )
 
 
 class TeleworkingRule(Rule):
 
+    trigger = 'realizar teletrabajo'
+
 
     class OptionNo(RuleOption):
 
         def can_apply(self, value: str) -> bool:
-            return 'no' in value.lower()
-
-        def apply(self, xml: Element, value: str) -> None:
-            update_rule_type(xml, '1614115961', 'block') # OpenVPN
+            return 'no' in value
 
+        def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
+            update_rule_type(trackers, '1614115961', 'block') # OpenVPN
 
-    def get_options(self) -> Iterable[RuleOption]:
-        return (
-            self.OptionNo(),
-        )
 
-    def can_apply(self, title: str) -> bool:
-        return 'realizar teletrabajo' in title.lower()
+    options = (
+        OptionNo(),
+    )
 
 
 class BlockBadTrafficRule(Rule):
 
+    trigger = 'sitios ociosos'
+
 
     class OptionNo(RuleOption):
 
         def can_apply(self, value: str) -> bool:
-            return 'no quiero bloquear' in value.lower()
+            return 'no quiero bloquear' in value
 
-        def apply(self, xml: Element, value: str) -> None:
-            update_node_value(xml, 'installedpackages/squidguarddefault/config/dest', 'all')
+        def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
+            update_node_value(xml, SQUIDGUARD_DEST_XPATH, 'all')
 
-            nodes = xml.findall('installedpackages/pfblockerngblacklist/item/selected')
-            for node in nodes:
+            for node in PFBLOCKERNG_SELECTED_XPATH(xml):
                 node.text = None
 
 
-    def get_options(self) -> Iterable[RuleOption]:
-        return (
-            self.OptionNo(),
-        )
-
-    def can_apply(self, title: str) -> bool:
-        return 'sitios ociosos' in title.lower()
+    options = (
+        OptionNo(),
+    )
 
 
 class AdminEmailRule(Rule):
 
+    trigger = 'correo electrónico'
+
 
     class Option(RuleOption):
 
         def can_apply(self, value: str) -> bool:
             return len(value) > 0
 
-        def apply(self, xml: Element, value: str) -> None:
-            update_node_value(xml, 'installedpackages/squid/config/admin_email', value)
+        def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
+            update_node_value(xml, SQUID_ADMIN_EMAIL_XPATH, value)
 
 
-    def get_options(self) -> Iterable[RuleOption]:
-        return (
-            self.Option(),
-        )
+    options = (
+        Option(),
+    )
 
-    def can_apply(self, title: str) -> bool:
-        return 'correo electrónico' in title.lower()
 
 class NetworkRule(Rule):
 
+    trigger = ' ruter de salida o gateway'
+
 
     class Option(RuleOption):
 
-        def can_apply(self, value: str) -> bool:        
-            return IPv4Network('192.168.100.1/24',strict=False).overlaps(IPv4Network(value,strict=False))
+        def can_apply(self, value: str) -> bool:
+            return BASE_LAN_NETWORK.overlaps(parse_network(value))
+
+        def apply(self, xml: Element, value: str, trackers: Dict[str, Element]) -> None:
+            update_node_value(xml, LAN_IPADDR_XPATH, '10.0.0.1')
 
-        def apply(self, xml: Element, value: str) -> None:
-            update_node_value(xml, 'interfaces/lan/ipaddr', '10.0.0.1')
-        
-    def get_options(self) -> Iterable[RuleOption]:
-        return (
-            self.Option(),
-        )
 
-    def can_apply(self, title: str) -> bool:
-        return ' ruter de salida o gateway' in title.lower()
+    options = (
+        Option(),
+    )
 
 
 RULES: Iterable[Rule] = (
@@ -252,6 +263,10 @@ RULES: Iterable[Rule] = (
     NetworkRule(),
 )
 
+# Rules by title trigger, and a pattern finding the trigger in a lower case title
+RULES_BY_TRIGGER: Dict[str, Rule] = {rule.trigger: rule for rule in RULES}
+TRIGGERS_RE = re.compile('|'.join(map(re.escape, RULES_BY_TRIGGER)))
+
 
 #################
 ## Main program
@@ -272,28 +287,33 @@ def get_excel_columns(filename: str, row_id: int) -> Iterable[Tuple[str, str]]:
     Iterable[Tuple[str, str]]
         The iterable of tuples (title, value) for the found row
     """
-    # Open workbook
-    wb = load_workbook(filename)
+    # Open workbook (read-only mode streams the sheet instead of building it)
+    wb = load_workbook(filename, read_only=True, data_only=True, keep_links=False)
     sheet = wb.active
+    # Do not trust the dimension declared in the sheet, it may be missing or wrong
+    sheet.reset_dimensions()
+    rows = sheet.iter_rows(values_only=True)
 
     # Get first row (columns titles)
-    first_row: List[Cell] = next(sheet.rows)
+    first_row: Tuple = next(rows)
     assert first_row is not None
 
     # Find wanted row
-    row: List[Cell] = []
+    row_id_str = str(row_id)
+    row: Optional[Tuple] = next((row for row in rows if row and str(row[0]) == row_id_str), None)
 
-    for row in sheet.rows:
-        if row[0].value == str(row_id):
-            break
+    # Read-only workbooks keep the file open until closed
+    wb.close()
 
-    if not row:
+    if row is None:
         print(f'Row with ID {row_id} was not found!')
         exit(3)
 
-    return ((str(title.value), str(cell.value)) for title, cell in zip(first_row, row))
+    return ((str(title), str(value)) for title, value in zip(first_row, row))
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
     if len(sys.argv) != 5:
         print('Usage: main.py <xlsx-path> <base-xml-path> <output-xml-path> <xlsx-row-id>')
         exit(1)
@@ -316,20 +336,25 @@ if __name__ == '__main__':
     print('Reading base configuration...')
 
     try:
-        xml_tree = ElementTree.parse(input_xml_file)
+        parser = etree.XMLParser(collect_ids=False, huge_tree=True, resolve_entities='internal', no_network=True)
+        xml_tree = etree.parse(input_xml_file, parser)
     except OSError:
         print('Could not open base configuration file!')
         exit(4)
 
     xml_root = xml_tree.getroot()
+    trackers = build_tracker_index(xml_root)
 
     print('Applying rules...')
 
     for title, value in columns:
-        for rule in RULES:
-            if rule.can_apply(title):
-                print(f'\tApplying rule {rule.__class__.__name__}')
-                rule.apply(xml_root, value)
+        match = TRIGGERS_RE.search(title.lower())
+        if match is None:
+            continue
+
+        rule = RULES_BY_TRIGGER[match.group()]
+        logger.debug('\tApplying rule %s', rule.__class__.__name__)
+        rule.apply(xml_root, value, trackers)
 
     print('Writing output...')
 